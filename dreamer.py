@@ -143,14 +143,19 @@ class Dreamer(nn.Module):
         mf_data_list = []
         for _ in range(self._config.mf_data_times):
             mf_data_list.append(next(self._dataset))
+        # built time-major, (time, batch, ...), as Behavior consumes it. the
+        # concatenation copies anyway, so the transpose comes for free here
         mf_data = {}
         for key in mf_data_list[0].keys():
-            mf_data[key] = np.concatenate([data[key] for data in mf_data_list], 0)
+            mf_data[key] = np.concatenate(
+                [data[key].swapaxes(0, 1) for data in mf_data_list], 1
+            )
         metrics.update(self._mf_behavior._train(start, mf_data)[-1])
 
         if self._config.expl_behavior != "greedy":
             mets = self._expl_behavior.train(start, context, data)[-1]
             metrics.update({"expl_" + key: value for key, value in mets.items()})
+        metrics = tools.scalars_to_np(metrics)
         for name, value in metrics.items():
             if not name in self._metrics.keys():
                 self._metrics[name] = [value]
@@ -163,7 +168,7 @@ def count_steps(folder):
 
 
 def make_dataset(episodes, config):
-    generator = tools.sample_episodes(episodes, config.batch_length)
+    generator = tools.sample_episodes(episodes, config.batch_length, config.seed)
     dataset = tools.from_generator(generator, config.batch_size)
     return dataset
 
@@ -229,11 +234,19 @@ def make_env(config, mode, id):
 
 
 def main(config):
+    rank = 0
+    if int(os.environ.get("WORLD_SIZE", "1")) > 1:
+        # data-parallel training under torchrun: every rank collects its own
+        # episodes and tools.Optimizer averages the gradients
+        rank = tools.init_distributed(config)
+        config.seed += rank * config.envs
     tools.set_seed_everywhere(config.seed)
     if config.deterministic_run:
         tools.enable_deterministic_run()
     date = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     name = 'dmc'+f'_{date}'
+    if rank:
+        name += f"_rank{rank}"
     logdir = pathlib.Path(config.logdir+'/'+name).expanduser()
     config.traindir = config.traindir or logdir / "train_eps"
     config.evaldir = config.evaldir or logdir / "eval_eps"
@@ -242,13 +255,14 @@ def main(config):
     config.log_every //= config.action_repeat
     config.time_limit //= config.action_repeat
 
-    wandb.init(
-        project="mfhmb",
-        sync_tensorboard=True,
-        name=name,
-        group=config.group,
-        config=config,
-        )
+    if rank == 0:
+        wandb.init(
+            project="mfhmb",
+            sync_tensorboard=True,
+            name=name,
+            group=config.group,
+            config=config,
+            )
 
     print("Logdir", logdir)
     logdir.mkdir(parents=True, exist_ok=True)
@@ -333,6 +347,9 @@ def main(config):
         agent.load_state_dict(checkpoint["agent_state_dict"])
         tools.recursively_load_optim_state_dict(agent, checkpoint["optims_state_dict"])
         agent._should_pretrain._once = False
+    if tools.is_distributed():
+        # start every rank from the weights of rank 0
+        tools.broadcast_module(agent)
 
     # make sure eval will be executed once after config.steps
     while agent._step < config.steps + config.eval_every:
@@ -1,4 +1,6 @@
 import copy
+import math
+import os
 import torch
 from torch import nn
 
@@ -16,17 +18,47 @@ class RewardEMA:
     def __init__(self, device, alpha=1e-2):
         self.device = device
         self.alpha = alpha
-        self.range = torch.tensor([0.05, 0.95]).to(device)
+        self.range = (0.05, 0.95)
+        self._numel = None
+        self._ranks = None
+        # reused by every call, the quantiles are consumed right away by lerp_
+        self._q_buf = torch.empty((2,), device=device)
 
     def __call__(self, x, ema_vals):
-        flat_x = torch.flatten(x.detach())
-        x_quantile = torch.quantile(input=flat_x, q=self.range)
+        flat_x = torch.flatten(x.detach()).float()
+        x_quantile = self._quantile(flat_x)
+        if tools.is_distributed():
+            # average the batch quantiles over workers so every replica keeps the
+            # same normalizer, just like the allreduced weights
+            torch.distributed.all_reduce(x_quantile)
+            x_quantile /= torch.distributed.get_world_size()
         # this should be in-place operation
-        ema_vals[:] = self.alpha * x_quantile + (1 - self.alpha) * ema_vals
+        ema_vals.lerp_(x_quantile, self.alpha)
         scale = torch.clip(ema_vals[1] - ema_vals[0], min=1.0)
         offset = ema_vals[0]
         return offset.detach(), scale.detach()
 
+    def _quantile(self, flat_x):
+        # same linear interpolation as torch.quantile, but only the two
+        # neighbouring order statistics are selected instead of sorting everything
+        numel = flat_x.shape[0]
+        if numel != self._numel:
+            self._numel = numel
+            self._ranks = []
+            for q in self.range:
+                pos = q * (numel - 1)
+                low = int(math.floor(pos))
+                high = min(low + 1, numel - 1)
+                # kthvalue is 1-indexed
+                self._ranks.append((low + 1, high + 1, pos - low))
+        values = []
+        for low, high, frac in self._ranks:
+            value = torch.kthvalue(flat_x, low).values
+            if frac > 0:
+                value = torch.lerp(value, torch.kthvalue(flat_x, high).values, frac)
+            values.append(value)
+        return torch.stack(values, out=self._q_buf)
+
 
 class WorldModel(nn.Module):
     def __init__(self, obs_space, act_space, step, config):
@@ -128,10 +160,10 @@ class WorldModel(nn.Module):
                 )
                 assert kl_loss.shape == embed.shape[:2], kl_loss.shape
                 preds = {}
+                post_feat = self.dynamics.get_feat(post)
                 for name, head in self.heads.items():
                     grad_head = name in self._config.grad_heads
-                    feat = self.dynamics.get_feat(post)
-                    feat = feat if grad_head else feat.detach()
+                    feat = post_feat if grad_head else post_feat.detach()
                     pred = head(feat)
                     if type(pred) is dict:
                         preds.update(pred)
@@ -149,63 +181,72 @@ class WorldModel(nn.Module):
                 model_loss = sum(scaled.values()) + kl_loss
             metrics = self._model_opt(torch.mean(model_loss), self.parameters())
 
-        metrics.update({f"{name}_loss": to_np(loss) for name, loss in losses.items()})
+        metrics.update(
+            {f"{name}_loss": torch.mean(loss).detach() for name, loss in losses.items()}
+        )
         metrics["kl_free"] = kl_free
         metrics["dyn_scale"] = dyn_scale
         metrics["rep_scale"] = rep_scale
-        metrics["dyn_loss"] = to_np(dyn_loss)
-        metrics["rep_loss"] = to_np(rep_loss)
-        metrics["kl"] = to_np(torch.mean(kl_value))
+        metrics["dyn_loss"] = torch.mean(dyn_loss).detach()
+        metrics["rep_loss"] = torch.mean(rep_loss).detach()
+        metrics["kl"] = torch.mean(kl_value).detach()
         with torch.cuda.amp.autocast(self._use_amp):
-            metrics["prior_ent"] = to_np(
-                torch.mean(self.dynamics.get_dist(prior).entropy())
-            )
-            metrics["post_ent"] = to_np(
-                torch.mean(self.dynamics.get_dist(post).entropy())
-            )
+            metrics["prior_ent"] = torch.mean(
+                self.dynamics.get_dist(prior).entropy()
+            ).detach()
+            post_ent = self.dynamics.get_dist(post).entropy()
+            metrics["post_ent"] = torch.mean(post_ent).detach()
             context = dict(
                 embed=embed,
-                feat=self.dynamics.get_feat(post),
+                feat=post_feat,
                 kl=kl_value,
-                postent=self.dynamics.get_dist(post).entropy(),
+                postent=post_ent,
             )
         post = {k: v.detach() for k, v in post.items()}
         return post, context, metrics
 
     # this function is called during both rollout and training
     def preprocess(self, obs):
-        obs = obs.copy()
-        obs["image"] = torch.Tensor(obs["image"].copy()) / 255.0
-        if "discount" in obs:
-            obs["discount"] *= self._config.discount
-            # (batch_size, batch_length) -> (batch_size, batch_length, 1)
-            obs["discount"] = torch.Tensor(obs["discount"]).unsqueeze(-1)
         # 'is_first' is necesarry to initialize hidden state at training
         assert "is_first" in obs
         # 'is_terminal' is necesarry to train cont_head
         assert "is_terminal" in obs
-        obs["cont"] = torch.Tensor(1.0 - obs["is_terminal"]).unsqueeze(-1)
-        obs = {k: torch.Tensor(v).to(self._config.device) for k, v in obs.items()}
+        device = torch.device(self._config.device)
+        # wrap the numpy arrays without copying and move them in their original
+        # dtype (uint8 images are 4x smaller), all scaling is done on the device
+        obs = {
+            k: torch.from_numpy(np.ascontiguousarray(v)) for k, v in obs.items()
+        }
+        if device.type == "cuda":
+            obs = {k: v.pin_memory() for k, v in obs.items()}
+        obs = {k: v.to(device, non_blocking=True).float() for k, v in obs.items()}
+        obs["image"] = obs["image"] / 255.0
+        if "discount" in obs:
+            # (batch_size, batch_length) -> (batch_size, batch_length, 1)
+            obs["discount"] = (obs["discount"] * self._config.discount).unsqueeze(-1)
+        obs["cont"] = (1.0 - obs["is_terminal"]).unsqueeze(-1)
         return obs
 
+    @torch.inference_mode()
     def video_pred(self, data):
-        data = self.preprocess(data)
+        # only the first 6 sequences are visualized, so transfer and encode just those
+        data = self.preprocess({k: v[:6] for k, v in data.items()})
         embed = self.encoder(data)
 
         states, _ = self.dynamics.observe(
-            embed[:6, :5], data["action"][:6, :5], data["is_first"][:6, :5]
+            embed[:, :5], data["action"][:, :5], data["is_first"][:, :5]
         )
-        recon = self.heads["decoder"](self.dynamics.get_feat(states))["image"].mode()[
-            :6
-        ]
-        reward_post = self.heads["reward"](self.dynamics.get_feat(states)).mode()[:6]
+        states_feat = self.dynamics.get_feat(states)
+        recon = self.heads["decoder"](states_feat)["image"].mode()
+        reward_post = self.heads["reward"](states_feat).mode()
         init = {k: v[:, -1] for k, v in states.items()}
-        prior = self.dynamics.imagine_with_action(data["action"][:6, 5:], init)
-        openl = self.heads["decoder"](self.dynamics.get_feat(prior))["image"].mode()
-        reward_prior = self.heads["reward"](self.dynamics.get_feat(prior)).mode()
+        prior = self.dynamics.imagine_with_action(data["action"][:, 5:], init)
+        prior_feat = self.dynamics.get_feat(prior)
+        openl = self.heads["decoder"](prior_feat)["image"].mode()
+        reward_prior = self.heads["reward"](prior_feat).mode()
         # observed image is given until 5 steps
         model = torch.cat([recon[:, :5], openl], 1)
-        truth = data["image"][:6]
+        truth = data["image"]
         model = model
         error = (model - truth + 1.0) / 2.0
 
@@ -251,9 +292,18 @@ class ImagBehavior(nn.Module):
             device=config.device,
             name="Value",
         )
+        # discount weights buffers, rewritten by every _compute_target
+        self._weights_cache = {}
+        self._slow_bf16 = config.critic["slow_bf16"] and tools.bf16_available(
+            config.device
+        )
         if config.critic["slow_target"]:
             self._slow_value = copy.deepcopy(self.value)
-            self._updates = 0
+            self._slow_target = tools.SlowTarget(
+                [self.value], [self._slow_value], config.critic, config.device
+            )
+        else:
+            self._slow_target = tools.SlowTarget()
         kw = dict(wd=config.weight_decay, opt=config.opt, use_amp=self._use_amp)
         self._actor_opt = tools.Optimizer(
             "actor",
@@ -281,6 +331,33 @@ class ImagBehavior(nn.Module):
             # register ema_vals to nn.Module for enabling torch.save and torch.load
             self.register_buffer("ema_vals", torch.zeros((2,)).to(self._config.device))
             self.reward_ema = RewardEMA(device=self._config.device)
+        # scanned over by _imagine, kept out of the state dict
+        self.register_buffer(
+            "_horizon_indices",
+            torch.arange(config.imag_horizon, device=config.device),
+            persistent=False,
+        )
+        if (
+            config.compile_train and os.name != "nt"
+        ):  # compilation is not supported on windows
+            # every imagination step runs the same graph on static shapes,
+            # so it can be replayed as a CUDA graph
+            self._imagine_step = torch.compile(
+                self._imagine_step, mode="reduce-overhead"
+            )
+            # the critic update only sees tensors of static shape
+            # (imag_horizon, batch), so its forward and backward are
+            # captured as well
+            self._compute_value_loss = torch.compile(
+                self._compute_value_loss, mode="reduce-overhead"
+            )
+        # closed forms of KL(actor || mf actor) for the mf_reg term
+        self._policy_kl = {
+            "normal": self._normal_kl,
+            "normal_std_fixed": self._normal_kl,
+            "trunc_normal": self._normal_kl,
+            "onehot": self._onehot_kl,
+        }.get(config.actor["dist"], self._registry_kl)
 
     def _train(
         self,
@@ -288,7 +365,7 @@ class ImagBehavior(nn.Module):
         objective,
         mf_policy
     ):
-        self._update_slow_target()
+        self._slow_target.update()
         metrics = {}
 
         with tools.RequiresGrad(self.actor):
@@ -303,36 +380,34 @@ class ImagBehavior(nn.Module):
                 target, weights, base = self._compute_target(
                     imag_feat, imag_state, reward
                 )
+                # shared by the actor loss and the mf regularizer
+                policy = self.actor(imag_feat.detach())
                 actor_loss, mets = self._compute_actor_loss(
                     imag_feat,
                     imag_action,
                     target,
                     weights,
                     base,
+                    policy,
+                    actor_ent,
                 )
-                actor_loss -= self._config.actor["entropy"] * actor_ent[:-1, ..., None]
 
                 if self._config.mf_reg:
-                    inp = imag_feat[:-1].detach()
-                    actor_loss += torch.distributions.kl.kl_divergence(self.actor(inp)._dist, mf_policy(inp)._dist)[:,:,None] * self._config.mf_reg_scale
+                    mf_reg = self._policy_kl(policy, mf_policy(imag_feat.detach()))
+                    actor_loss += mf_reg[:-1, :, None] * self._config.mf_reg_scale
 
                 actor_loss = torch.mean(actor_loss)
                 metrics.update(mets)
                 value_input = imag_feat
 
+        self._slow_target.wait()
         with tools.RequiresGrad(self.value):
             with torch.cuda.amp.autocast(self._use_amp):
-                value = self.value(value_input[:-1].detach())
-                target = torch.stack(target, dim=1)
-                # (time, batch, 1), (time, batch, 1) -> (time, batch)
-                value_loss = -value.log_prob(target.detach())
-                slow_target = self._slow_value(value_input[:-1].detach())
-                if self._config.critic["slow_target"]:
-                    value_loss -= value.log_prob(slow_target.mode().detach())
-                # (time, batch, 1), (time, batch, 1) -> (1,)
-                value_loss = torch.mean(weights[:-1] * value_loss[:, :, None])
-
-        metrics.update(tools.tensorstats(value.mode(), "value"))
+                value_loss, value_mode = self._compute_value_loss(
+                    value_input, target, weights, self._slow_bf16
+                )
+
+        metrics.update(tools.tensorstats(value_mode, "value"))
         metrics.update(tools.tensorstats(target, "target"))
         metrics.update(tools.tensorstats(reward, "imag_reward"))
         if self._config.actor["dist"] in ["onehot"]:
@@ -343,32 +418,55 @@ class ImagBehavior(nn.Module):
             )
         else:
             metrics.update(tools.tensorstats(imag_action, "imag_action"))
-        metrics["actor_entropy"] = to_np(torch.mean(actor_ent))
+        metrics["actor_entropy"] = torch.mean(actor_ent).detach()
         with tools.RequiresGrad(self):
             metrics.update(self._actor_opt(actor_loss, self.actor.parameters()))
             metrics.update(self._value_opt(value_loss, self.value.parameters()))
         return imag_feat, imag_state, imag_action, weights, metrics
 
+    def _compute_value_loss(self, value_input, target, weights, slow_bf16):
+        # compiled with torch.compile, so keep this to tensor ops and plain
+        # autocast / no_grad blocks that dynamo can trace without graph breaks
+        value = self.value(value_input[:-1].detach())
+        # (time, batch, 1), (time, batch, 1) -> (time, batch)
+        value_loss = -value.log_prob(target.detach())
+        if self._config.critic["slow_target"]:
+            with torch.no_grad():
+                if slow_bf16:
+                    with torch.autocast("cuda", dtype=torch.bfloat16):
+                        slow_target = self._slow_value(value_input[:-1]).mode()
+                else:
+                    slow_target = self._slow_value(value_input[:-1]).mode()
+            value_loss -= value.log_prob(slow_target.float())
+        # (time, batch, 1), (time, batch, 1) -> (1,)
+        value_loss = torch.mean(weights[:-1] * value_loss[:, :, None])
+        return value_loss, value.mode().detach()
+
     def _imagine(self, start, policy, horizon):
-        dynamics = self._world_model.dynamics
         flatten = lambda x: x.reshape([-1] + list(x.shape[2:]))
         start = {k: flatten(v) for k, v in start.items()}
-
-        def step(prev, _):
-            state, _, _ = prev
-            feat = dynamics.get_feat(state)
-            inp = feat.detach()
-            action = policy(inp).sample()
-            succ = dynamics.img_step(state, action)
-            return succ, feat, action
-
+        step = lambda prev, _: self._imagine_step(prev[0], policy)
         succ, feats, actions = tools.static_scan(
-            step, [torch.arange(horizon)], (start, None, None)
+            step, [self._horizon_index(horizon)], (start, None, None)
         )
         states = {k: torch.cat([start[k][None], v[:-1]], 0) for k, v in succ.items()}
 
         return feats, states, actions
 
+    def _horizon_index(self, horizon):
+        # the cached range covers imag_horizon, longer rollouts build their own
+        if horizon > len(self._horizon_indices):
+            return torch.arange(horizon)
+        return self._horizon_indices[:horizon]
+
+    def _imagine_step(self, state, policy):
+        dynamics = self._world_model.dynamics
+        feat = dynamics.get_feat(state)
+        inp = feat.detach()
+        action = policy(inp).sample()
+        succ = dynamics.img_step(state, action)
+        return succ, feat, action
+
     def _compute_target(self, imag_feat, imag_state, reward):
         if "cont" in self._world_model.heads:
             inp = self._world_model.dynamics.get_feat(imag_state)
@@ -384,9 +482,7 @@ class ImagBehavior(nn.Module):
             lambda_=self._config.discount_lambda,
             axis=0,
         )
-        weights = torch.cumprod(
-            torch.cat([torch.ones_like(discount[:1]), discount[:-1]], 0), 0
-        ).detach()
+        weights = tools.discount_weights(discount, self._weights_cache)
         return target, weights, value[:-1]
 
     def _compute_actor_loss(
@@ -396,48 +492,73 @@ class ImagBehavior(nn.Module):
         target,
         weights,
         base,
+        policy,
+        actor_ent,
     ):
         metrics = {}
-        inp = imag_feat.detach()
-        policy = self.actor(inp)
         # Q-val for actor is not transformed using symlog
-        target = torch.stack(target, dim=1)
         if self._config.reward_EMA:
             offset, scale = self.reward_ema(target, self.ema_vals)
-            normed_target = (target - offset) / scale
-            normed_base = (base - offset) / scale
-            adv = normed_target - normed_base
+            # (target - offset) / scale - (base - offset) / scale
+            adv = (target - base).div_(scale)
+            # -offset / scale + target / scale in one kernel
+            normed_target = torch.addcdiv(-offset / scale, target.detach(), scale)
             metrics.update(tools.tensorstats(normed_target, "normed_target"))
-            metrics["EMA_005"] = to_np(self.ema_vals[0])
-            metrics["EMA_095"] = to_np(self.ema_vals[1])
+            ema_vals = self.ema_vals.clone()
+            metrics["EMA_005"] = ema_vals[0]
+            metrics["EMA_095"] = ema_vals[1]
 
         if self._config.imag_gradient == "dynamics":
             actor_target = adv
         elif self._config.imag_gradient == "reinforce":
+            # base is the critic mode on imag_feat[:-1] from _compute_target
             actor_target = (
                 policy.log_prob(imag_action)[:-1][:, :, None]
-                * (target - self.value(imag_feat[:-1]).mode()).detach()
+                * (target - base).detach()
             )
         elif self._config.imag_gradient == "both":
+            # base is the critic mode on imag_feat[:-1] from _compute_target
             actor_target = (
                 policy.log_prob(imag_action)[:-1][:, :, None]
-                * (target - self.value(imag_feat[:-1]).mode()).detach()
+                * (target - base).detach()
             )
             mix = self._config.imag_gradient_mix
-            actor_target = mix * target + (1 - mix) * actor_target
             metrics["imag_gradient_mix"] = mix
         else:
             raise NotImplementedError(self._config.imag_gradient)
-        actor_loss = -weights[:-1] * actor_target
+        if self._config.imag_gradient == "both":
+            # -weights * (mix * target + (1 - mix) * actor_target) - entropy bonus
+            actor_loss = tools.mixed_actor_loss(
+                weights[:-1],
+                target,
+                actor_target,
+                mix,
+                actor_ent[:-1, ..., None],
+                self._config.actor["entropy"],
+            )
+        else:
+            # -weights * actor_target - entropy bonus
+            actor_loss = tools.actor_loss(
+                weights[:-1],
+                actor_target,
+                actor_ent[:-1, ..., None],
+                self._config.actor["entropy"],
+            )
         return actor_loss, metrics
 
-    def _update_slow_target(self):
-        if self._config.critic["slow_target"]:
-            if self._updates % self._config.critic["slow_target_update"] == 0:
-                mix = self._config.critic["slow_target_fraction"]
-                for s, d in zip(self.value.parameters(), self._slow_value.parameters()):
-                    d.data = mix * s.data + (1 - mix) * d.data
-            self._updates += 1
+    def _normal_kl(self, policy, other):
+        # KL(N(m1, s1) || N(m2, s2)) summed over action dims
+        p, q = policy._dist.base_dist, other._dist.base_dist
+        var_ratio = (p.scale / q.scale) ** 2
+        t1 = ((p.loc - q.loc) / q.scale) ** 2
+        return (0.5 * (var_ratio + t1 - 1 - torch.log(var_ratio))).sum(-1)
+
+    def _onehot_kl(self, policy, other):
+        # logits of OneHotCategorical are already normalized log-probs
+        return (policy.probs * (policy.logits - other.logits)).sum(-1)
+
+    def _registry_kl(self, policy, other):
+        return torch.distributions.kl.kl_divergence(policy._dist, other._dist)
 
 class Behavior(nn.Module):
     def __init__(self, config, world_model):
@@ -495,10 +616,25 @@ class Behavior(nn.Module):
             device=config.device,
             name="Value",
         )
+        # discount weights buffers, rewritten by every _compute_target
+        self._weights_cache = {}
+        self._slow_bf16 = config.critic["slow_bf16"] and tools.bf16_available(
+            config.device
+        )
+        # observed feature buffers, rewritten by every _data_sample
+        self._feat_cache = {}
+        self._td3_bf16 = config.mf_td3_bf16 and tools.bf16_available(config.device)
         if config.critic["slow_target"]:
             self._slow_value_1 = copy.deepcopy(self.value_1)
             self._slow_value_2 = copy.deepcopy(self.value_2)
-            self._updates = 0
+            self._slow_target = tools.SlowTarget(
+                [self.value_1, self.value_2],
+                [self._slow_value_1, self._slow_value_2],
+                config.critic,
+                config.device,
+            )
+        else:
+            self._slow_target = tools.SlowTarget()
         kw = dict(wd=config.weight_decay, opt=config.opt, use_amp=self._use_amp)
         self._actor_opt = tools.Optimizer(
             "mf_actor",
@@ -533,18 +669,27 @@ class Behavior(nn.Module):
         print(
             f"Optimizer value_opt has {sum(param.numel() for param in self.value_2.parameters())} variables."
         )
+        # plain host int, mf_policy_freq is checked against it on the host
         self.total_it = 0
         if self._config.reward_EMA:
             # register ema_vals to nn.Module for enabling torch.save and torch.load
             self.register_buffer("ema_vals", torch.zeros((2,)).to(self._config.device))
             self.reward_ema = RewardEMA(device=self._config.device)
+        if (
+            config.compile_train and os.name != "nt"
+        ):  # compilation is not supported on windows
+            # the td3 actor objective is a short chain of small GRU and MLP
+            # kernels on static shapes, so it is replayed as a CUDA graph
+            self._td3_value = torch.compile(
+                self._td3_value, mode="reduce-overhead", dynamic=False
+            )
 
     def _train(
         self,
         start,
         data,
     ):
-        self._update_slow_target()
+        self._slow_target.update()
         metrics = {}
         mf = "mf"
         self.total_it += 1
@@ -555,12 +700,14 @@ class Behavior(nn.Module):
                 # reuse feat_extractor
 
                 feat, next_feat, state, action, reward, discount = self._data_sample(start, data)
-                actor_ent = self.actor(feat).entropy()
+                # the actor is only updated every mf_policy_freq iterations
+                update_actor = self.total_it % self._config.mf_policy_freq == 0
                 # this target is not scaled by ema or sym_log.
                 target, weights, base = self._compute_target(
                     next_feat, state, reward, discount
                 )
-                if self.total_it % self._config.mf_policy_freq == 0:
+                if update_actor:
+                    actor_ent = self.actor(feat).entropy()
                     actor_loss, mets = self._compute_actor_loss(
                         feat,
                         action,
@@ -568,8 +715,8 @@ class Behavior(nn.Module):
                         weights,
                         base,
                         state,
+                        actor_ent,
                     )
-                    actor_loss -= self._config.actor["entropy"] * actor_ent[:-1, ..., None]
                     actor_loss = torch.mean(actor_loss)
                     metrics.update(mets)
                 value_input = feat
@@ -596,19 +743,25 @@ class Behavior(nn.Module):
                 # value_input = torch.cat([embed, action], dim=-1)
 
 
+        self._slow_target.wait()
         with tools.RequiresGrad(self.value_1):
             with tools.RequiresGrad(self.value_2):
                 with torch.cuda.amp.autocast(self._use_amp):
-                    value_1 = self.value_1(value_input[:-1].detach())
-                    value_2 = self.value_2(value_input[:-1].detach())
+                    value_1, value_2 = networks.ensemble_forward(
+                        [self.value_1, self.value_2], value_input[:-1].detach()
+                    )
                     value = torch.min(value_1.mode(), value_2.mode())
-                    target = torch.stack(target, dim=1)
                     # (time, batch, 1), (time, batch, 1) -> (time, batch)
                     value_loss = -value_1.log_prob(target.detach()) -value_2.log_prob(target.detach())
-                    slow_target_1 = self._slow_value_1(value_input[:-1].detach())
-                    slow_target_2 = self._slow_value_2(value_input[:-1].detach())
                     if self._config.critic["slow_target"]:
-                        value_loss -= value_1.log_prob(slow_target_1.mode().detach()) + value_2.log_prob(slow_target_2.mode().detach())
+                        with torch.no_grad(), tools.bf16_autocast(self._slow_bf16):
+                            slow_target_1, slow_target_2 = networks.ensemble_forward(
+                                [self._slow_value_1, self._slow_value_2],
+                                value_input[:-1].detach(),
+                            )
+                            slow_target_1 = slow_target_1.mode().float()
+                            slow_target_2 = slow_target_2.mode().float()
+                        value_loss -= value_1.log_prob(slow_target_1) + value_2.log_prob(slow_target_2)
                     # (time, batch, 1), (time, batch, 1) -> (1,)
                     value_loss = torch.mean(weights[:-1] * value_loss[:, :, None])
 
@@ -623,9 +776,10 @@ class Behavior(nn.Module):
             )
         else:
             metrics.update(tools.tensorstats(action, "mf_action"))
-        metrics["mf_actor_entropy"] = to_np(torch.mean(actor_ent))
+        if update_actor:
+            metrics["mf_actor_entropy"] = torch.mean(actor_ent).detach()
         with tools.RequiresGrad(self):
-            if self.total_it % 2 == 0:
+            if update_actor:
                 metrics.update(self._actor_opt(actor_loss, self.actor.parameters()))
             metrics.update(self._value_opt_1(value_loss, self.value_1.parameters()))
             metrics.update(self._value_opt_2(value_loss, self.value_2.parameters()))
@@ -634,7 +788,7 @@ class Behavior(nn.Module):
     # reuse feat_extractor
 
     def _data_sample(self, start, data):
-        swap = lambda x: x.permute([1, 0] + list(range(2, len(x.shape))))
+        # data is sampled time-major, (time, batch, ...), so nothing is swapped here
         start = {k: v[:,0] for k, v in start.items()}
         data = self._world_model.preprocess(data)
         rewards = data.pop('reward').unsqueeze(-1)
@@ -661,21 +815,26 @@ class Behavior(nn.Module):
         # feats = swap(feats)
         # actions = swap(actions)
 
-        states, _ = self._world_model.dynamics.observe(embed, actions, data['is_first'])
-        feats = self._world_model.dynamics.get_feat(states)
+        states, _ = self._world_model.dynamics.observe(
+            embed, actions, data['is_first'], time_major=True
+        )
+        # the observed states carry no gradient, so their features are written
+        # into a buffer kept across steps. next_feats below depend on the actor
+        # and the td3 objective differentiates through get_feat, so those are
+        # allocated as usual
+        key = (tuple(states["deter"].shape), states["deter"].dtype)
+        feats = self._world_model.dynamics.get_feat(
+            states, out=self._feat_cache.get(key)
+        )
+        self._feat_cache[key] = feats
 
-        noise = (torch.rand_like(actions) * 0.2).clamp(-0.5, 0.5)
+        # symmetric target policy smoothing noise as in td3, the previous
+        # (rand * 0.2).clamp(-0.5, 0.5) was always positive and never clipped
+        noise = torch.empty_like(actions).uniform_(-0.2, 0.2)
         noise_actions = self.actor(feats).sample() + noise
         noise_states = self._world_model.dynamics.img_step(states, noise_actions)
         next_feats = self._world_model.dynamics.get_feat(noise_states)
 
-        feats = swap(feats)
-        next_feats = swap(next_feats)
-        actions = swap(actions)
-        states = {k: swap(v) for k, v in states.items()}
-        rewards = swap(rewards)
-        discount = swap(discount)
-
         feats = feats.detach()
         states = {k: v.detach() for k, v in states.items()}
 
@@ -689,9 +848,8 @@ class Behavior(nn.Module):
         return feats, next_feats, states, actions, rewards, discount
 
     def _compute_target(self, feat, state, reward, discount):
-        value_1 = self.value_1(feat).mode()
-        value_2 = self.value_2(feat).mode()
-        value = torch.min(value_1, value_2)
+        value_1, value_2 = networks.ensemble_forward([self.value_1, self.value_2], feat)
+        value = torch.minimum(value_1.mode(), value_2.mode())
         target = tools.lambda_return(
             reward[1:],
             value[:-1],
@@ -700,9 +858,7 @@ class Behavior(nn.Module):
             lambda_=self._config.discount_lambda,
             axis=0,
         )
-        weights = torch.cumprod(
-            torch.cat([torch.ones_like(discount[:1]), discount[:-1]], 0), 0
-        ).detach()
+        weights = tools.discount_weights(discount, self._weights_cache)
         return target, weights, value[:-1]
 
     def _compute_actor_loss(
@@ -713,50 +869,74 @@ class Behavior(nn.Module):
         weights,
         base,
         state,
+        actor_ent,
     ):
         metrics = {}
         inp = feat.detach()
         policy = self.actor(inp)
         # Q-val for actor is not transformed using symlog
-        target = torch.stack(target, dim=1)
         if self._config.reward_EMA:
             offset, scale = self.reward_ema(target, self.ema_vals)
-            normed_target = (target - offset) / scale
-            normed_base = (base - offset) / scale
-            adv = normed_target - normed_base
+            # (target - offset) / scale - (base - offset) / scale
+            adv = (target - base).div_(scale)
+            # -offset / scale + target / scale in one kernel
+            normed_target = torch.addcdiv(-offset / scale, target.detach(), scale)
             metrics.update(tools.tensorstats(normed_target, "mf_normed_target"))
-            metrics["mf_EMA_005"] = to_np(self.ema_vals[0])
-            metrics["mf_EMA_095"] = to_np(self.ema_vals[1])
+            ema_vals = self.ema_vals.clone()
+            metrics["mf_EMA_005"] = ema_vals[0]
+            metrics["mf_EMA_095"] = ema_vals[1]
 
         if self._config.mf_gradient == "dynamics":
             actor_target = adv
-            actor_loss = -weights[:-1] * actor_target
         elif self._config.mf_gradient == "reinforce":
             actor_target = (
                 policy.log_prob(action)[:-1][:, :, None]
                 * (target - self.value_1(feat[:-1]).mode()).detach()
             )
-            actor_loss = -weights[:-1] * actor_target
         elif self._config.mf_gradient == "both":
             actor_target = (
                 policy.log_prob(action)[:-1][:, :, None]
                 * (target - self.value_1(feat[:-1]).mode()).detach()
             )
             mix = self._config.imag_gradient_mix
-            actor_target = mix * target + (1 - mix) * actor_target
             metrics["mf_gradient_mix"] = mix
-            actor_loss = -weights[:-1] * actor_target
         elif self._config.mf_gradient == "td3":
             pi = policy.sample()
-            succ = self._world_model.dynamics.img_step(state, pi)
-            succ_feat = self._world_model.dynamics.get_feat(succ)
-            value = self.value_1(succ_feat).mean()
-            actor_loss = -value[:-1]
+            with tools.bf16_autocast(self._td3_bf16):
+                value = self._td3_value(state, pi)
+            # no return weighting, the critic value itself is maximized:
+            # -(value[:-1] + entropy * actor_ent[:-1]) on a view of value
+            actor_loss = torch.add(
+                value.narrow(0, 0, value.size(0) - 1),
+                actor_ent[:-1, ..., None],
+                alpha=self._config.actor["entropy"],
+            ).neg_()
             # actor_loss += torch.nn.functional.mse_loss(pi, action.detach())
+            return actor_loss, metrics
         else:
             raise NotImplementedError(self._config.mf_gradient)
+        if self._config.mf_gradient == "both":
+            actor_loss = tools.mixed_actor_loss(
+                weights[:-1],
+                target,
+                actor_target,
+                mix,
+                actor_ent[:-1, ..., None],
+                self._config.actor["entropy"],
+            )
+        else:
+            actor_loss = tools.actor_loss(
+                weights[:-1],
+                actor_target,
+                actor_ent[:-1, ..., None],
+                self._config.actor["entropy"],
+            )
         return actor_loss, metrics
 
+    def _td3_value(self, state, action):
+        succ = self._world_model.dynamics.img_step(state, action)
+        return self.value_1(self._world_model.dynamics.get_feat(succ)).mean()
+
     # # reuse docoder only
 
     # def _data_sample(self, start, data):
@@ -854,13 +1034,3 @@ class Behavior(nn.Module):
     #     else:
     #         raise NotImplementedError(self._config.mf_gradient)
     #     return actor_loss, metrics
-
-    def _update_slow_target(self):
-        if self._config.critic["slow_target"]:
-            if self._updates % self._config.critic["slow_target_update"] == 0:
-                mix = self._config.critic["slow_target_fraction"]
-                for s, d in zip(self.value_1.parameters(), self._slow_value_1.parameters()):
-                    d.data = mix * s.data + (1 - mix) * d.data
-                for s, d in zip(self.value_2.parameters(), self._slow_value_2.parameters()):
-                    d.data = mix * s.data + (1 - mix) * d.data
-            self._updates += 1
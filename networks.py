@@ -124,8 +124,11 @@ class RSSM(nn.Module):
         else:
             raise NotImplementedError(self._initial)
 
-    def observe(self, embed, action, is_first, state=None):
+    def observe(self, embed, action, is_first, state=None, time_major=False):
+        # time_major inputs are already (time, batch, ch) and the outputs stay so
         swap = lambda x: x.permute([1, 0] + list(range(2, len(x.shape))))
+        if time_major:
+            swap = lambda x: x
         # (batch, time, ch) -> (time, batch, ch)
         embed, action, is_first = swap(embed), swap(action), swap(is_first)
         # prev_state[0] means selecting posterior of return(posterior, prior) from obs_step
@@ -152,12 +155,14 @@ class RSSM(nn.Module):
         prior = {k: swap(v) for k, v in prior.items()}
         return prior
 
-    def get_feat(self, state):
+    def get_feat(self, state, out=None):
+        # out can only be given when no gradient flows through the state,
+        # cat does not support autograd with out=
         stoch = state["stoch"]
         if self._discrete:
             shape = list(stoch.shape[:-2]) + [self._stoch * self._discrete]
             stoch = stoch.reshape(shape)
-        return torch.cat([stoch, state["deter"]], -1)
+        return torch.cat([stoch, state["deter"]], -1, out=out)
 
     def get_dist(self, state, dtype=None):
         if self._discrete:
@@ -483,13 +488,16 @@ class ConvEncoder(nn.Module):
         self.outdim = out_dim // 2 * h * w
         self.layers = nn.Sequential(*layers)
         self.layers.apply(tools.weight_init)
+        # NHWC weights let cudnn pick the tensor core kernels without transposes
+        self.layers.to(memory_format=torch.channels_last)
 
     def forward(self, obs):
         obs -= 0.5
         # (batch, time, h, w, ch) -> (batch * time, h, w, ch)
         x = obs.reshape((-1,) + tuple(obs.shape[-3:]))
         # (batch * time, h, w, ch) -> (batch * time, ch, h, w)
-        x = x.permute(0, 3, 1, 2)
+        # the permuted view is already channels_last, so this does not copy
+        x = x.permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
         x = self.layers(x)
         # (batch * time, ...) -> (batch * time, -1)
         x = x.reshape([x.shape[0], np.prod(x.shape[1:])])
@@ -740,6 +748,44 @@ class MLP(nn.Module):
         return dist
 
 
+def ensemble_forward(mlps, features):
+    # evaluate identically shaped MLPs on the same input with batched matmuls,
+    # so each layer is one kernel for the whole ensemble instead of one per member.
+    # the weights are stacked on every call, so gradients still reach each member
+    first = mlps[0]
+    assert first._shape is not None and not isinstance(first._shape, dict)
+    assert not hasattr(first, "std_layer"), "learned std is not supported"
+    x = features
+    if first._symlog_inputs:
+        x = tools.symlog(x)
+    batch_shape = x.shape[:-1]
+    # (..., ch) -> (ensemble, batch, ch)
+    x = x.reshape(1, -1, x.shape[-1]).expand(len(mlps), -1, -1)
+    for layers in zip(*[m.layers for m in mlps]):
+        layer = layers[0]
+        if isinstance(layer, nn.Linear):
+            # MLP builds its trunk linears without bias
+            assert all(l.bias is None for l in layers), "linear bias is not supported"
+            weight = torch.stack([l.weight for l in layers])
+            x = torch.bmm(x, weight.transpose(1, 2))
+        elif isinstance(layer, nn.LayerNorm):
+            x = F.layer_norm(x, layer.normalized_shape, eps=layer.eps)
+            weight = torch.stack([l.weight for l in layers])[:, None]
+            bias = torch.stack([l.bias for l in layers])[:, None]
+            x = torch.addcmul(bias, x, weight)
+        else:
+            # member 0's module is applied to the whole ensemble, which is only
+            # right for parameter-free layers such as the activations
+            if any(len(list(l.parameters())) for l in layers):
+                raise NotImplementedError(type(layer).__name__)
+            x = layer(x)
+    weight = torch.stack([m.mean_layer.weight for m in mlps])
+    bias = torch.stack([m.mean_layer.bias for m in mlps])[:, None]
+    mean = torch.baddbmm(bias, x, weight.transpose(1, 2))
+    mean = mean.reshape((len(mlps),) + tuple(batch_shape) + (-1,))
+    return [m.dist(m._dist, mean[i], m._std, m._shape) for i, m in enumerate(mlps)]
+
+
 class GRUCell(nn.Module):
     def __init__(self, inp_size, size, norm=True, act=torch.tanh, update_bias=-1):
         super(GRUCell, self).__init__()
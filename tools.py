@@ -1,5 +1,6 @@
 import datetime
 import collections
+import contextlib
 import io
 import os
 import json
@@ -39,6 +40,25 @@ class RequiresGrad:
         self._model.requires_grad_(requires_grad=False)
 
 
+def bf16_available(device):
+    # checked once at construction, not on every step
+    device = torch.device(device)
+    return (
+        device.type == "cuda"
+        and torch.cuda.is_available()
+        and torch.cuda.is_bf16_supported()
+    )
+
+
+def bf16_autocast(enabled):
+    # bf16 compute with fp32 parameters, so slow target updates stay exact and,
+    # unlike fp16, gradients need no loss scaling. when disabled the enclosing
+    # autocast (e.g. fp16 amp) stays in effect
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast("cuda", dtype=torch.bfloat16)
+
+
 class TimeRecording:
     def __init__(self, comment):
         self._comment = comment
@@ -688,10 +708,27 @@ def static_scan_for_lambda_return(fn, inputs, start):
             outputs = torch.cat([outputs, last], dim=-1)
     outputs = torch.reshape(outputs, [outputs.shape[0], outputs.shape[1], 1])
     outputs = torch.flip(outputs, [1])
-    outputs = torch.unbind(outputs, dim=0)
+    # (batch, time, 1) -> (time, batch, 1)
+    outputs = outputs.transpose(0, 1)
     return outputs
 
 
+def parallel_lambda_return(inputs, decay, bootstrap):
+    # solves returns[t] = inputs[t] + decay[t] * returns[t + 1] for all t at once
+    # instead of one step per kernel launch. returns[t] = sum_k w[t, k] * inputs[k]
+    # + w[t, T] * bootstrap with w[t, k] = prod_{t <= j < k} decay[j], built by a
+    # cumprod over a (time, time, ...) matrix. unlike the flip/cumsum closed form
+    # this never divides by the running product, so terminal steps (decay = 0) are exact
+    steps = inputs.shape[0]
+    upper = torch.ones(steps, steps, dtype=torch.bool, device=inputs.device).triu()
+    upper = upper.reshape(upper.shape + (1,) * (inputs.dim() - 1))
+    # prods[t, k] = prod_{t <= j <= k} decay[j] for k >= t
+    prods = torch.where(upper, decay[None], torch.ones_like(decay[None])).cumprod(1)
+    weights = torch.cat([torch.ones_like(prods[:, :1]), prods[:, :-1]], 1)
+    weights = torch.where(upper, weights, torch.zeros_like(weights))
+    return (weights * inputs[None]).sum(1) + prods[:, -1] * bootstrap[None]
+
+
 def lambda_return(reward, value, pcont, bootstrap, lambda_, axis):
     # Setting lambda=1 gives a discounted Monte Carlo return.
     # Setting lambda=0 gives a fixed 1-step return.
@@ -713,14 +750,109 @@ def lambda_return(reward, value, pcont, bootstrap, lambda_, axis):
     #    lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg,
     #    (inputs, pcont), bootstrap, reverse=True)
     # reimplement to optimize performance
-    returns = static_scan_for_lambda_return(
-        lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg, (inputs, pcont), bootstrap
-    )
+    if torch.jit.is_tracing():
+        returns = static_scan_for_lambda_return(
+            lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg,
+            (inputs, pcont),
+            bootstrap,
+        )
+    else:
+        returns = parallel_lambda_return(inputs, pcont * lambda_, bootstrap)
     if axis != 0:
         returns = returns.permute(dims)
     return returns
 
 
+@torch.jit.script
+def actor_loss(
+    weights: torch.Tensor,
+    actor_target: torch.Tensor,
+    entropy: torch.Tensor,
+    entropy_scale: float,
+) -> torch.Tensor:
+    # the whole elementwise tail of the actor loss in one fusable function
+    return -weights * actor_target - entropy_scale * entropy
+
+
+@torch.jit.script
+def mixed_actor_loss(
+    weights: torch.Tensor,
+    target: torch.Tensor,
+    actor_target: torch.Tensor,
+    mix: float,
+    entropy: torch.Tensor,
+    entropy_scale: float,
+) -> torch.Tensor:
+    # same as actor_loss, blending in the differentiable target. only used by
+    # the "both" gradient, otherwise target would be backpropagated for nothing
+    return -weights * (mix * target + (1 - mix) * actor_target) - entropy_scale * entropy
+
+
+def discount_weights(discount, cache=None):
+    # weights[t] = prod(discount[:t]) along axis 0, filled and scanned in place
+    # instead of concatenating a row of ones in front of discount.
+    # with a cache dict the buffer is reused by every call with the same shape,
+    # so the result is only valid until the next call
+    with torch.no_grad():
+        if cache is None:
+            weights = torch.empty_like(discount)
+        else:
+            key = (tuple(discount.shape), discount.dtype, discount.device)
+            if key not in cache:
+                cache[key] = torch.empty_like(discount)
+            weights = cache[key]
+        weights[:1] = 1.0
+        weights[1:] = discount[:-1]
+        weights.cumprod_(0)
+    return weights
+
+
+class SlowTarget:
+    # polyak averaged copies of modules, as used for the slow critics. the blend
+    # runs on a side cuda stream and overlaps with the start of the next training
+    # step, so wait() must be called before the copies are read or the sources
+    # are written. without modules both calls are no-ops
+    def __init__(self, sources=(), targets=(), config=None, device=None):
+        if not targets:
+            self.update = self.wait = lambda: None
+            return
+        self._src = [p for m in sources for p in m.parameters()]
+        self._dst = [p for m in targets for p in m.parameters()]
+        self._mix = config["slow_target_fraction"]
+        self._period = config["slow_target_update"]
+        # power of two periods (the default 1 included) are checked with a
+        # mask instead of a modulo
+        period = self._period
+        self._mask = period - 1 if period & (period - 1) == 0 else None
+        self._device = torch.device(device)
+        # created on the device of the modules, not the current device
+        self._stream = (
+            torch.cuda.Stream(device=self._device)
+            if self._device.type == "cuda" and torch.cuda.is_available()
+            else None
+        )
+        # plain host int, the period check must never read a device value
+        self._updates = 0
+
+    def update(self):
+        if self._mask is not None:
+            due = (self._updates & self._mask) == 0
+        else:
+            due = self._updates % self._period == 0
+        if due:
+            if self._stream is not None:
+                # read the sources only after the last optimizer step wrote them
+                self._stream.wait_stream(torch.cuda.current_stream(self._device))
+            # d = mix * s + (1 - mix) * d for all parameters in one fused kernel
+            with torch.no_grad(), torch.cuda.stream(self._stream):
+                torch._foreach_lerp_(self._dst, self._src, self._mix)
+        self._updates += 1
+
+    def wait(self):
+        if self._stream is not None:
+            torch.cuda.current_stream(self._device).wait_stream(self._stream)
+
+
 class Optimizer:
     def __init__(
         self,
@@ -733,6 +865,7 @@ class Optimizer:
         wd_pattern=r".*",
         opt="adam",
         use_amp=False,
+        bucket_mb=25,
     ):
         assert 0 <= wd < 1
         assert not clip or 1 <= clip
@@ -749,13 +882,18 @@ class Optimizer:
             "momentum": lambda: torch.optim.SGD(parameters, lr=lr, momentum=0.9),
         }[opt]()
         self._scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+        self._bucket_size = bucket_mb * 2**20
 
     def __call__(self, loss, params, retain_graph=True):
         assert len(loss.shape) == 0, loss.shape
         metrics = {}
-        metrics[f"{self._name}_loss"] = loss.detach().cpu().numpy()
+        metrics[f"{self._name}_loss"] = loss.detach()
         self._opt.zero_grad()
         self._scaler.scale(loss).backward(retain_graph=retain_graph)
+        if is_distributed():
+            # blocking average once backward is done, nothing overlaps with it.
+            # sync before unscale_ so every worker sees the same inf/nan check
+            self._allreduce_grads()
         self._scaler.unscale_(self._opt)
         # loss.backward(retain_graph=retain_graph)
         norm = torch.nn.utils.clip_grad_norm_(params, self._clip)
@@ -765,9 +903,41 @@ class Optimizer:
         self._scaler.update()
         # self._opt.step()
         self._opt.zero_grad()
-        metrics[f"{self._name}_grad_norm"] = norm.item()
+        metrics[f"{self._name}_grad_norm"] = norm.detach()
         return metrics
 
+    def _allreduce_grads(self):
+        # average gradients over data-parallel workers after backward has
+        # finished. the grads are only flattened into buckets so that there are
+        # a few large collectives instead of one per parameter
+        world_size = torch.distributed.get_world_size()
+        grads = [
+            p.grad
+            for group in self._opt.param_groups
+            for p in group["params"]
+            if p.grad is not None
+        ]
+        buckets, bucket, size = [], [], 0
+        for grad in grads:
+            if bucket and (
+                size + grad.numel() * grad.element_size() > self._bucket_size
+                or grad.dtype != bucket[0].dtype
+            ):
+                buckets.append(bucket)
+                bucket, size = [], 0
+            bucket.append(grad)
+            size += grad.numel() * grad.element_size()
+        if bucket:
+            buckets.append(bucket)
+        for bucket in buckets:
+            flat = torch._utils._flatten_dense_tensors(bucket)
+            torch.distributed.all_reduce(flat)
+            flat /= world_size
+            for grad, synced in zip(
+                bucket, torch._utils._unflatten_dense_tensors(flat, bucket)
+            ):
+                grad.copy_(synced)
+
     def _apply_weight_decay(self, varibs):
         nontrivial = self._wd_pattern != r".*"
         if nontrivial:
@@ -776,6 +946,26 @@ class Optimizer:
             var.data = (1 - self._wd) * var.data
 
 
+def is_distributed():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def init_distributed(config):
+    # one process per GPU, as launched by torchrun
+    backend = "nccl" if torch.cuda.is_available() else "gloo"
+    torch.distributed.init_process_group(backend)
+    if torch.cuda.is_available():
+        config.device = f"cuda:{int(os.environ['LOCAL_RANK'])}"
+        torch.cuda.set_device(config.device)
+    return torch.distributed.get_rank()
+
+
+def broadcast_module(module, src=0):
+    # state_dict tensors share storage with the parameters and buffers
+    for value in module.state_dict().values():
+        torch.distributed.broadcast(value, src)
+
+
 def args_type(default):
     def parse_string(x):
         if default is None:
@@ -799,48 +989,27 @@ def args_type(default):
 def static_scan(fn, inputs, start):
     last = start
     indices = range(inputs[0].shape[0])
-    flag = True
+    steps = []
+    # fn may reassign entries of the previous state dict (e.g. obs_step on
+    # is_first), so keep a shallow copy of every dict it returns
+    snapshot = lambda x: dict(x) if type(x) == type({}) else x
     for index in indices:
         inp = lambda x: (_input[x] for _input in inputs)
         last = fn(last, *inp(index))
-        if flag:
-            if type(last) == type({}):
-                outputs = {
-                    key: value.clone().unsqueeze(0) for key, value in last.items()
-                }
-            else:
-                outputs = []
-                for _last in last:
-                    if type(_last) == type({}):
-                        outputs.append(
-                            {
-                                key: value.clone().unsqueeze(0)
-                                for key, value in _last.items()
-                            }
-                        )
-                    else:
-                        outputs.append(_last.clone().unsqueeze(0))
-            flag = False
+        if type(last) == type({}):
+            steps.append(snapshot(last))
         else:
-            if type(last) == type({}):
-                for key in last.keys():
-                    outputs[key] = torch.cat(
-                        [outputs[key], last[key].unsqueeze(0)], dim=0
-                    )
-            else:
-                for j in range(len(outputs)):
-                    if type(last[j]) == type({}):
-                        for key in last[j].keys():
-                            outputs[j][key] = torch.cat(
-                                [outputs[j][key], last[j][key].unsqueeze(0)], dim=0
-                            )
-                    else:
-                        outputs[j] = torch.cat(
-                            [outputs[j], last[j].unsqueeze(0)], dim=0
-                        )
+            steps.append([snapshot(_last) for _last in last])
+    # stack every output once at the end instead of growing it with
+    # torch.cat at each step, which copies the whole history every time
+    stack = lambda xs: (
+        {key: torch.stack([x[key] for x in xs], 0) for key in xs[0].keys()}
+        if type(xs[0]) == type({})
+        else torch.stack(xs, 0)
+    )
     if type(last) == type({}):
-        outputs = [outputs]
-    return outputs
+        return [stack(steps)]
+    return [stack([step[j] for step in steps]) for j in range(len(last))]
 
 
 class Every:
@@ -940,17 +1109,29 @@ def uniform_weight_init(given_scale):
 
 
 def tensorstats(tensor, prefix=None):
+    # kept on device, scalars_to_np copies them to the host in one go
+    tensor = tensor.detach()
     metrics = {
-        "mean": to_np(torch.mean(tensor)),
-        "std": to_np(torch.std(tensor)),
-        "min": to_np(torch.min(tensor)),
-        "max": to_np(torch.max(tensor)),
+        "mean": torch.mean(tensor),
+        "std": torch.std(tensor),
+        "min": torch.min(tensor),
+        "max": torch.max(tensor),
     }
     if prefix:
         metrics = {f"{prefix}_{k}": v for k, v in metrics.items()}
     return metrics
 
 
+def scalars_to_np(metrics):
+    # every to_np is a device sync, so gather all scalar tensors of a train
+    # step and move them to the host with a single copy
+    keys = [k for k, v in metrics.items() if torch.is_tensor(v)]
+    if keys:
+        values = torch.stack([metrics[k].detach().float().reshape(()) for k in keys])
+        metrics.update(zip(keys, to_np(values)))
+    return metrics
+
+
 def set_seed_everywhere(seed):
     torch.manual_seed(seed)
     if torch.cuda.is_available():